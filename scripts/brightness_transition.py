@@ -1,47 +1,106 @@
+import math
 import time
+import asyncio
 
 def ease_out(t):
     """Ease-out function for smooth transitions."""
     return 1 - (1 - t) ** 3  # Cubic ease-out
 
-def smooth_transition(current, target, duration=5.0, step_size=2, setter=None, reader=None):
+def _plan_ramp(current, target, duration, step_size, hw_steps):
     """
-    Smoothly transitions from `current` to `target` using precise timing and feedback.
-    
-    - `setter`: function to apply each brightness level.
-    - `reader`: function to re-read actual brightness for sync (optional).
-    - `step_size`: step size in percent (default 2).
-    - `duration`: total transition duration (in seconds).
+    Precomputes the eased ramp shared by the sync and async transitions.
+
+    Every step and the target are snapped to a raw hardware level (1..`hw_steps`).
+    Returns `(ramp, final, delay, step_quant)`, where `ramp` is a list of
+    `(percent, raw_level)` pairs and `final` is the snapped target pair.
     """
-    if current == target:
-        return  # Nothing to do
+    import numpy as np
 
     diff = abs(target - current)
     steps = max(diff // step_size, 1)
     delay = duration / steps
     direction = 1 if target > current else -1
 
-    for step in range(steps):
-        # Use ease-out to change brightness progressively
-        progress = ease_out(step / steps)
-        transition_value = current + (diff * progress * direction)
+    # One hardware level in percent; readback can only match to within that
+    step_quant = math.ceil(100 / hw_steps) + 1
 
-        # Clamp between 5–100%
-        transition_value = max(5, min(100, int(transition_value)))
+    def snap(percent):
+        # Never level 0: that switches many backlights off
+        raw = np.maximum(1, np.round(np.clip(percent, 5, 100) * hw_steps / 100)).astype(np.int64)
+        return np.clip(np.round(raw * 100 / hw_steps), 5, 100).astype(np.int32), raw
 
-        if setter:
-            setter(transition_value)
-        else:
-            print(f"Would set: {transition_value}%")
+    # Precompute the whole eased ramp in one vectorized pass
+    t = np.arange(steps, dtype=np.float32) / steps
+    progress = ease_out(t)
+    values, levels = snap((current + diff * progress * direction).astype(np.int32))
+    target_value, target_level = snap(target)
 
-        # Optional: verify if actual brightness is applied
-        if reader:
-            while abs(reader() - transition_value) > 1:
-                time.sleep(0.05)
+    ramp = list(zip(values.tolist(), levels.tolist()))
+    return ramp, (int(target_value), int(target_level)), delay, step_quant
 
-        time.sleep(delay)
+def _ramp_steps(ramp, final, delay, step_quant, setter, reader):
+    """
+    Applies a planned ramp step by step, yielding how long to sleep before continuing.
+
+    Shared by the sync and async transitions, which differ only in how they sleep.
+    """
+    start = time.monotonic()
+    last_level = None
+    for i, (transition_value, level) in enumerate(ramp):
+        # Each step ends at an absolute deadline so pacing doesn't drift over the ramp
+        deadline = start + (i + 1) * delay
+
+        # Steps that snap to the same hardware level just keep the pacing
+        if level != last_level:
+            last_level = level
+            if setter:
+                setter(transition_value)
+            else:
+                print(f"Would set: {transition_value}%")
+
+            # Optional: verify if actual brightness is applied, but never past this step's deadline
+            if reader:
+                while abs(reader() - transition_value) > step_quant and time.monotonic() < deadline:
+                    yield 0.01
+
+        yield max(0, deadline - time.monotonic())
 
     # Final correction
-    if setter:
+    target, target_level = final
+    if setter and target_level != last_level:
         setter(target)
 
+def smooth_transition(current, target, duration=5.0, step_size=2, setter=None, reader=None, hw_steps=100):
+    """
+    Smoothly transitions from `current` to `target` using precise timing and feedback.
+    
+    - `setter`: function to apply each brightness level.
+    - `reader`: function to re-read actual brightness for sync (optional).
+    - `step_size`: step size in percent (default 2).
+    - `duration`: total transition duration (in seconds).
+    - `hw_steps`: number of hardware brightness levels (e.g. `max_brightness`).
+
+    Returns the (hardware-snapped) level it finished at, or None if nothing changed.
+    """
+    if current == target:
+        return  # Nothing to do
+
+    ramp, final, delay, step_quant = _plan_ramp(current, target, duration, step_size, hw_steps)
+    for pause in _ramp_steps(ramp, final, delay, step_quant, setter, reader):
+        time.sleep(pause)
+    return final[0]
+
+async def smooth_transition_async(current, target, duration=5.0, step_size=2, setter=None, reader=None, hw_steps=100):
+    """
+    Same as `smooth_transition`, but yields to the event loop between steps.
+
+    Other tasks (e.g. re-reading ambient light) can run during the ramp, and
+    cancelling the task aborts the transition at the current step.
+    """
+    if current == target:
+        return  # Nothing to do
+
+    ramp, final, delay, step_quant = _plan_ramp(current, target, duration, step_size, hw_steps)
+    for pause in _ramp_steps(ramp, final, delay, step_quant, setter, reader):
+        await asyncio.sleep(pause)
+    return final[0]
@@ -1,67 +1,81 @@
 import os
-import time
+import queue
 import json
 import shutil
 import numpy as np
 import cv2
 from datetime import datetime
 from brightness_transition import smooth_transition  # if needed, else you can remove this
+from frame_utils import trimmed_means, start_frame_producer, gray_frame, request_raw_yuyv, drain_frames, set_camera_controls
 
 # Paths relative to this script
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.abspath(os.path.join(BASE_DIR, "../data"))
 PROFILE_PATH = os.path.join(DATA_DIR, "ambient_light_profile.json")
+# Tags profiles measured on raw luma (no equalizeHist); smart_brightness recalibrates untagged ones
+PROFILE_SCALE = "raw"
 BACKLIGHT_PATH = '/sys/class/backlight/intel_backlight'
 
 # Create data directory if not exists
 os.makedirs(DATA_DIR, exist_ok=True)
 
-def calibrate_camera():
+def calibrate_camera(cap=None):
+    """
+    Samples ambient brightness and saves it as the calibration profile.
+
+    - `cap`: already-open VideoCapture to reuse (opened and released here if omitted).
+    """
     print("[🚀] Starting camera calibration...")
 
-    cap = cv2.VideoCapture(0)
+    owns_cap = cap is None
+    if owns_cap:
+        cap = cv2.VideoCapture(0)
     if not cap.isOpened():
         print("[❌] Webcam not available.")
         return None
 
     cap.set(cv2.CAP_PROP_FRAME_WIDTH, 320)
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 240)
-    cap.set(cv2.CAP_PROP_EXPOSURE, -6)
-    cap.set(cv2.CAP_PROP_CONTRAST, 50)
-    cap.set(cv2.CAP_PROP_BRIGHTNESS, 100)
-
-    usable_brightness = []
+    # One V4L2 ioctl for exposure/contrast/brightness; per-property cap.set() only as a fallback
+    if not set_camera_controls():
+        cap.set(cv2.CAP_PROP_EXPOSURE, -6)
+        cap.set(cv2.CAP_PROP_CONTRAST, 50)
+        cap.set(cv2.CAP_PROP_BRIGHTNESS, 100)
+    request_raw_yuyv(cap)
+    drain_frames(cap)
+
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    stack = np.empty((10, height, width), np.uint8)
     frames_captured = 0
     max_attempts = 40
+    frames, stop, producer = start_frame_producer(cap)
 
     while frames_captured < 10 and max_attempts > 0:
-        ret, frame = cap.read()
-        if not ret:
-            time.sleep(0.05)
+        try:
+            frame = frames.get(timeout=0.1)
+        except queue.Empty:
             max_attempts -= 1
             continue
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.equalizeHist(gray)
-
-        flat = gray.flatten()
-        lower = np.percentile(flat, 10)
-        upper = np.percentile(flat, 90)
-        trimmed = flat[(flat >= lower) & (flat <= upper)]
+        # Raw luma, no equalizeHist: equalizing would measure the redistribution, not the light
+        gray_frame(frame, stack[frames_captured])
+        frames_captured += 1
 
-        if len(trimmed) > 0:
-            usable_brightness.append(np.mean(trimmed))
-            frames_captured += 1
-
-        time.sleep(0.05)
         max_attempts -= 1
 
-    cap.release()
+    stop.set()
+    producer.join()
+    if owns_cap:
+        cap.release()
 
-    if not usable_brightness:
+    if frames_captured == 0:
         print("[❌] No usable frame captured.")
         return None
 
+    # Trimmed mean of every captured frame in one batched pass
+    usable_brightness = trimmed_means(stack[:frames_captured], lo=0.10, hi=0.90)
+
     final_brightness = float(np.median(usable_brightness))
     print(f"[🧠] Ambient brightness (median of samples): {final_brightness:.2f}")
 
@@ -71,6 +85,7 @@ def calibrate_camera():
         "ambient_median": final_brightness,
         "camera_resolution": [320, 240],
         "fps_expected": 30,
+        "scale": PROFILE_SCALE,
         "timestamp": str(datetime.now())
     }
 
@@ -0,0 +1,219 @@
+import os
+import time
+import fcntl
+import queue
+import ctypes
+import threading
+import numpy as np
+import cv2
+
+# Run the per-frame preprocessing chain through OpenCV's T-API when OpenCL is usable
+USE_OPENCL = cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
+
+V4L2_DEVICE = "/dev/video0"
+
+# V4L2 control IDs from linux/videodev2.h / v4l2-controls.h (stable across kernel versions,
+# unlike the control names, which were renamed in 5.x)
+V4L2_CID_BRIGHTNESS = 0x00980900
+V4L2_CID_CONTRAST = 0x00980901
+V4L2_CID_EXPOSURE_AUTO = 0x009a0901
+V4L2_CID_EXPOSURE_ABSOLUTE = 0x009a0902
+V4L2_EXPOSURE_MANUAL = 1
+V4L2_CTRL_WHICH_CUR_VAL = 0
+
+
+class _V4L2ExtControlValue(ctypes.Union):
+    _fields_ = [("value", ctypes.c_int32), ("value64", ctypes.c_int64), ("ptr", ctypes.c_void_p)]
+
+
+class _V4L2ExtControl(ctypes.Structure):
+    # struct v4l2_ext_control is declared __attribute__((packed))
+    _pack_ = 1
+    _fields_ = [
+        ("id", ctypes.c_uint32),
+        ("size", ctypes.c_uint32),
+        ("reserved2", ctypes.c_uint32 * 1),
+        ("u", _V4L2ExtControlValue),
+    ]
+
+
+class _V4L2ExtControls(ctypes.Structure):
+    _fields_ = [
+        ("which", ctypes.c_uint32),
+        ("count", ctypes.c_uint32),
+        ("error_idx", ctypes.c_uint32),
+        ("request_fd", ctypes.c_int32),
+        ("reserved", ctypes.c_uint32 * 1),
+        ("controls", ctypes.POINTER(_V4L2ExtControl)),
+    ]
+
+
+# _IOWR('V', 72, struct v4l2_ext_controls)
+VIDIOC_S_EXT_CTRLS = (3 << 30) | (ctypes.sizeof(_V4L2ExtControls) << 16) | (ord("V") << 8) | 72
+
+
+def trimmed_means(stack, lo=0.10, hi=0.90):
+    """
+    Per-frame mean of the pixels between the `lo` and `hi` percentiles
+    of a stacked (N, H, W) batch of 8-bit frames.
+
+    Each frame is reduced to a 256-bin histogram, and the percentile bins
+    and weighted means are then computed for the whole batch at once,
+    so no pixels are ever sorted, copied or masked.
+    """
+    hist = np.stack([cv2.calcHist([frame], [0], None, [256], [0, 256]).ravel() for frame in stack])
+    cdf = np.cumsum(hist, axis=1)
+    total = cdf[:, -1:]
+
+    # First bin whose cumulative count reaches each percentile
+    lo_bin = np.argmax(cdf >= lo * total, axis=1)
+    hi_bin = np.argmax(cdf >= hi * total, axis=1)
+
+    bins = np.arange(256)
+    in_range = (bins >= lo_bin[:, None]) & (bins <= hi_bin[:, None])
+    counts = hist * in_range
+    return (counts * bins).sum(axis=1) / counts.sum(axis=1)
+
+
+def set_camera_controls(device=V4L2_DEVICE, exposure=156, contrast=50, brightness=100):
+    """
+    Applies manual exposure, contrast and brightness straight through V4L2.
+
+    All controls go in a single VIDIOC_S_EXT_CTRLS ioctl with explicit control IDs,
+    instead of one OpenCV property mapping (and ioctl) per setting. Controls are
+    per-device, so this works whether or not a VideoCapture already has it open.
+    `exposure` is in 100 µs units (156 ≈ 2^-6 s). Returns False if the device
+    can't be opened or rejects the controls, so the caller can fall back to cap.set().
+    """
+    settings = (
+        (V4L2_CID_EXPOSURE_AUTO, V4L2_EXPOSURE_MANUAL),
+        (V4L2_CID_EXPOSURE_ABSOLUTE, exposure),
+        (V4L2_CID_CONTRAST, contrast),
+        (V4L2_CID_BRIGHTNESS, brightness),
+    )
+    controls = (_V4L2ExtControl * len(settings))()
+    for control, (cid, value) in zip(controls, settings):
+        control.id = cid
+        control.u.value = value
+
+    ext = _V4L2ExtControls(which=V4L2_CTRL_WHICH_CUR_VAL, count=len(settings), controls=controls)
+
+    try:
+        fd = os.open(device, os.O_RDWR)
+    except OSError:
+        return False
+    try:
+        fcntl.ioctl(fd, VIDIOC_S_EXT_CTRLS, ext)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def request_raw_yuyv(cap):
+    """
+    Asks the driver for unconverted YUYV frames so grayscale is just the Y plane.
+
+    Returns False (and restores BGR conversion) if the camera doesn't accept YUYV.
+    """
+    yuyv = cv2.VideoWriter_fourcc(*"YUYV")
+    cap.set(cv2.CAP_PROP_FOURCC, yuyv)
+    cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+    if int(cap.get(cv2.CAP_PROP_FOURCC)) != yuyv:
+        cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        return False
+    return True
+
+
+def luma_mean(frame, shape, step=2):
+    """
+    Coarse mean luma of a BGR or raw YUYV frame, sampling every `step`-th pixel.
+
+    Works on the frame as captured (no conversion, blur or device upload), so it's
+    cheap enough to reject dark frames before gray_frame does any work on them.
+    `shape` is the (height, width) of the image.
+    """
+    if frame.ndim == 3 and frame.shape[2] == 3:
+        # BGR2GRAY is a fixed weighted sum, so its mean is the same sum of channel means
+        b, g, r = cv2.mean(frame[::step, ::step])[:3]
+        return 0.114 * b + 0.587 * g + 0.299 * r
+    return float(frame.reshape(shape[0], shape[1], 2)[::step, ::step, 0].mean())
+
+
+def gray_frame(frame, dst, blur_ksize=0):
+    """
+    Converts a BGR or raw YUYV frame to grayscale into `dst`, optionally median-blurred.
+
+    Raw YUYV frames skip color conversion entirely: the luma bytes are extracted directly.
+    With OpenCL the chain runs on a UMat, so the intermediates stay on the
+    device and only the final image is copied back into `dst`; otherwise the
+    last step writes into `dst` directly.
+    """
+    is_bgr = frame.ndim == 3 and frame.shape[2] == 3
+    if not is_bgr:
+        # YUYV packs Y0 U Y1 V, so luma is channel 0 of an (H, W, 2) view
+        frame = frame.reshape(dst.shape[0], dst.shape[1], 2)
+
+    def to_gray(src, out=None):
+        if is_bgr:
+            return cv2.cvtColor(src, cv2.COLOR_BGR2GRAY, dst=out)
+        return cv2.extractChannel(src, 0, dst=out)
+
+    if USE_OPENCL:
+        gray = to_gray(cv2.UMat(frame))
+        if blur_ksize:
+            gray = cv2.medianBlur(gray, blur_ksize)
+        dst[...] = gray.get()
+    elif blur_ksize:
+        # medianBlur can't run in place, so only the blur writes into dst
+        cv2.medianBlur(to_gray(frame), blur_ksize, dst=dst)
+    else:
+        to_gray(frame, dst)
+    return dst
+
+
+def drain_frames(cap, count=3):
+    """
+    Grabs and discards `count` frames so the driver's warm-up frames
+    (taken while exposure/format changes settle) never reach sampling.
+    """
+    for _ in range(count):
+        cap.grab()
+
+
+def _produce_frames(cap, frames, stop):
+    while not stop.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            time.sleep(0.05)
+            continue
+
+        # Drop the oldest queued frame so the consumer always sees fresh ones
+        try:
+            frames.put_nowait(frame)
+        except queue.Full:
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                frames.put_nowait(frame)
+            except queue.Full:
+                pass
+
+
+def start_frame_producer(cap, maxsize=2):
+    """
+    Starts a daemon thread that keeps reading `cap` into a bounded queue.
+
+    Capture (a blocking read that releases the GIL) then overlaps with the
+    caller's processing. Returns `(frames, stop, thread)`: set `stop` and join
+    `thread` before releasing `cap`.
+    """
+    frames = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    thread = threading.Thread(target=_produce_frames, args=(cap, frames, stop), daemon=True)
+    thread.start()
+    return frames, stop, thread
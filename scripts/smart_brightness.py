@@ -1,11 +1,10 @@
 import os
 import shutil
-import time
+import queue
 import json
+import asyncio
 import subprocess
-import numpy as np
-import cv2
-from brightness_transition import smooth_transition  # Renamed 'transition.py' to 'brightness_transition.py'
+from brightness_transition import smooth_transition_async  # Renamed 'transition.py' to 'brightness_transition.py'
 
 # Paths relative to this script
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -17,11 +16,41 @@ BACKLIGHT_PATH = '/sys/class/backlight/intel_backlight'
 # Ensure the necessary directories and files exist
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# In-process cache of the loaded profile, keyed by (path, mtime)
+_profile_cache = {}
+
+# Profiles measured on raw luma are tagged with this; untagged ones were recorded on the
+# old equalizeHist scale and don't match what get_average_brightness samples
+PROFILE_SCALE = "raw"
+
+# Read once: max_brightness never changes while the system is up
+def _read_max_brightness():
+    try:
+        with open(os.path.join(BACKLIGHT_PATH, "max_brightness")) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+MAX_BRIGHTNESS = _read_max_brightness()
+
+# Kept open so get_current_brightness is a single pread instead of open/read/close
+try:
+    _BRIGHTNESS_READ_FD = os.open(os.path.join(BACKLIGHT_PATH, "brightness"), os.O_RDONLY)
+except OSError:
+    _BRIGHTNESS_READ_FD = None
+
+# Backlight fd kept open across set_brightness calls; False once sysfs writes are known to be denied
+_brightness_write_fd = None
+
+# Set once the missing-brightnessctl warning has been shown, so a ramp doesn't repeat it every step
+_brightnessctl_missing_warned = False
+
 # Function to create a default camera profile if not found
 def create_default_profile():
     default_profile = {
         "ambient_min": 40,
-        "ambient_max": 170
+        "ambient_max": 170,
+        "scale": PROFILE_SCALE
     }
     try:
         with open(PROFILE_PATH, "w") as f:
@@ -30,95 +59,157 @@ def create_default_profile():
     except Exception as e:
         print(f"[⚠️] Failed to create default profile: {e}")
 
-# Load calibration data dynamically
-def load_camera_profile():
-    if not os.path.exists(PROFILE_PATH):
-        print(f"[📊] Calibration data not found at {PROFILE_PATH}. Running calibration...")
-        print(f"[🧠] Using calibration script at: {CALIBRATION_SCRIPT}")
+def _read_profile():
+    key = (PROFILE_PATH, os.path.getmtime(PROFILE_PATH))
+    if _profile_cache.get("key") == key:
+        return _profile_cache["value"]
 
-        if not os.path.exists(CALIBRATION_SCRIPT):
-            print(f"[❌] Calibration script not found at: {CALIBRATION_SCRIPT}")
-            create_default_profile()
-            return None
+    with open(PROFILE_PATH, "r") as f:
+        profile = json.load(f)
+    _profile_cache["key"] = key
+    _profile_cache["value"] = profile
+    return profile
 
+# Load calibration data dynamically
+def load_camera_profile(cap=None):
+    """
+    Loads the calibration profile, running calibration first if none exists
+    or the saved one predates raw-luma sampling.
+
+    - `cap`: already-open VideoCapture; if given, calibration runs in-process on it
+      instead of spawning the calibration script (which would reopen the camera).
+    """
+    reason = None
+    if not os.path.exists(PROFILE_PATH):
+        reason = f"Calibration data not found at {PROFILE_PATH}"
+    else:
         try:
-            VENV_PYTHON = os.path.abspath(os.path.join(BASE_DIR, "../venv/bin/python"))
-            result = subprocess.run([VENV_PYTHON, CALIBRATION_SCRIPT], check=True, capture_output=True, text=True)
-            print(result.stdout)
-            if result.stderr:
-                print(f"[stderr] {result.stderr}")
-        except subprocess.CalledProcessError as e:
-            print(f"[❌] Calibration failed with return code {e.returncode}")
-            print(f"[stdout] {e.stdout}")
-            print(f"[stderr] {e.stderr}")
-            create_default_profile()
+            if _read_profile().get("scale") != PROFILE_SCALE:
+                reason = f"Calibration data at {PROFILE_PATH} uses the old equalized scale"
+        except Exception as e:
+            print(f"[⚠️] Failed to load calibration data: {e}")
             return None
 
+    if reason:
+        print(f"[📊] {reason}. Running calibration...")
+
+        if cap is not None:
+            from calibration import calibrate_camera
+
+            # Like the script path, a failed run (e.g. no usable frame) writes nothing and is retried next start;
+            # an exception (what makes the script exit nonzero) falls back to the default profile
+            try:
+                if calibrate_camera(cap) is None:
+                    return None
+            except Exception as e:
+                print(f"[❌] Calibration failed: {e}")
+                create_default_profile()
+                return None
+        else:
+            print(f"[🧠] Using calibration script at: {CALIBRATION_SCRIPT}")
+
+            if not os.path.exists(CALIBRATION_SCRIPT):
+                print(f"[❌] Calibration script not found at: {CALIBRATION_SCRIPT}")
+                create_default_profile()
+                return None
+
+            try:
+                VENV_PYTHON = os.path.abspath(os.path.join(BASE_DIR, "../venv/bin/python"))
+                result = subprocess.run([VENV_PYTHON, CALIBRATION_SCRIPT], check=True, capture_output=True, text=True)
+                print(result.stdout)
+                if result.stderr:
+                    print(f"[stderr] {result.stderr}")
+            except subprocess.CalledProcessError as e:
+                print(f"[❌] Calibration failed with return code {e.returncode}")
+                print(f"[stdout] {e.stdout}")
+                print(f"[stderr] {e.stderr}")
+                create_default_profile()
+                return None
+
     try:
-        with open(PROFILE_PATH, "r") as f:
-            return json.load(f)
+        profile = _read_profile()
     except Exception as e:
         print(f"[⚠️] Failed to load calibration data: {e}")
         return None
 
-def get_average_brightness():
+    if profile.get("scale") != PROFILE_SCALE:
+        # Recalibration ran but didn't replace the old profile (e.g. no usable frame); retry next start
+        print("[⚠️] Calibration did not produce a new profile.")
+        return None
+    return profile
+
+def get_average_brightness(profile=None, cap=None):
     """
     Captures frames from webcam and calculates average brightness.
+
+    - `profile`: already-loaded camera profile (loaded from disk if omitted).
+    - `cap`: already-open VideoCapture to reuse (opened and released here if omitted).
     """
-    print("[📸] Initializing webcam...")
-    cap = cv2.VideoCapture(0)
-    if not cap.isOpened():
-        print("[❌] Webcam not available.")
-        return None
+    # Heavy imports deferred to here so brightness-only paths start fast
+    import numpy as np
+    import cv2
+    from frame_utils import trimmed_means, start_frame_producer, gray_frame, luma_mean, request_raw_yuyv, drain_frames
 
     # Get resolution and FPS from profile
-    profile = load_camera_profile()
+    if profile is None:
+        profile = load_camera_profile(cap)
     if not profile:
         return None
 
+    owns_cap = cap is None
+    if owns_cap:
+        print("[📸] Initializing webcam...")
+        cap = cv2.VideoCapture(0)
+    if not cap.isOpened():
+        print("[❌] Webcam not available.")
+        return None
+
     camera_resolution = profile.get("camera_resolution", [320, 240])
     fps_expected = profile.get("fps_expected", 30)
     
     cap.set(cv2.CAP_PROP_FRAME_WIDTH, camera_resolution[0])
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_resolution[1])
     cap.set(cv2.CAP_PROP_FPS, fps_expected)
+    request_raw_yuyv(cap)
+    drain_frames(cap)
 
-    usable_brightness = []
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    stack = np.empty((10, height, width), np.uint8)
     frames_captured = 0
     max_attempts = 40
+    frames, stop, producer = start_frame_producer(cap)
 
     while frames_captured < 10 and max_attempts > 0:
-        ret, frame = cap.read()
-        if not ret:
-            time.sleep(0.05)
+        try:
+            frame = frames.get(timeout=0.1)
+        except queue.Empty:
             max_attempts -= 1
             continue
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        if np.mean(gray) <= 10:
-            time.sleep(0.05)
+        # Darkness gate only needs a coarse estimate of the unblurred luma, so dark
+        # frames are rejected before any conversion, blur or OpenCL upload
+        if luma_mean(frame, (height, width)) <= 10:
             max_attempts -= 1
             continue
 
-        gray = cv2.medianBlur(gray, 5)
-        flat = gray.flatten()
-        lower = np.percentile(flat, 10)
-        upper = np.percentile(flat, 90)
-        trimmed = flat[(flat >= lower) & (flat <= upper)]
-
-        if len(trimmed) > 0:
-            usable_brightness.append(np.mean(trimmed))
-            frames_captured += 1
+        gray_frame(frame, stack[frames_captured], blur_ksize=5)
+        frames_captured += 1
 
-        time.sleep(0.05)
         max_attempts -= 1
 
-    cap.release()
+    stop.set()
+    producer.join()
+    if owns_cap:
+        cap.release()
 
-    if not usable_brightness:
+    if frames_captured == 0:
         print("[❌] No usable frame captured.")
         return None
 
+    # Trimmed mean of every captured frame in one batched pass
+    usable_brightness = trimmed_means(stack[:frames_captured], lo=0.10, hi=0.90)
+
     final_brightness = float(np.median(usable_brightness))
     print(f"[🧠] Ambient brightness (median of samples): {final_brightness:.2f}")
     return final_brightness
@@ -128,47 +219,95 @@ def get_current_brightness():
     Gets current screen brightness percentage.
     """
     try:
-        with open(os.path.join(BACKLIGHT_PATH, "brightness")) as f:
-            current = int(f.read())
-        with open(os.path.join(BACKLIGHT_PATH, "max_brightness")) as f:
-            max_brightness = int(f.read())
-        return int((current / max_brightness) * 100)
+        if _BRIGHTNESS_READ_FD is None or not MAX_BRIGHTNESS:
+            raise OSError(f"backlight not available at {BACKLIGHT_PATH}")
+        current = int(os.pread(_BRIGHTNESS_READ_FD, 32, 0))
+        return int((current / MAX_BRIGHTNESS) * 100)
     except Exception as e:
         print(f"[⚠️] Could not read brightness: {e}")
         return 50
 
 
-def set_brightness(percent):
+def set_brightness(percent, verbose=True):
     """
-    Sets screen brightness using brightnessctl.
+    Sets screen brightness by writing to the backlight sysfs file,
+    falling back to brightnessctl when that fails.
+
+    - `verbose`: print the result of each call (disabled for per-step ramp calls).
+
+    Returns the applied percentage, or None if no method could set it.
     """
+    global _brightness_write_fd, _brightnessctl_missing_warned
+    percent = max(5, min(100, int(percent)))
+
+    if MAX_BRIGHTNESS and _brightness_write_fd is not False:
+        try:
+            if _brightness_write_fd is None:
+                _brightness_write_fd = os.open(os.path.join(BACKLIGHT_PATH, "brightness"), os.O_WRONLY)
+            # Round to the nearest level, never to 0: that would switch many backlights off
+            raw = max(1, round(percent * MAX_BRIGHTNESS / 100))
+            os.pwrite(_brightness_write_fd, str(raw).encode(), 0)
+            if verbose:
+                print(f"[🔆] Screen brightness set to: {percent}%")
+            return percent
+        except OSError as e:
+            # Denied or rejected by the driver: stop trying sysfs and use brightnessctl from now on
+            print(f"[⚠️] Could not write brightness via sysfs: {e}")
+            if _brightness_write_fd is not None:
+                os.close(_brightness_write_fd)
+            _brightness_write_fd = False
+
     if not shutil.which("brightnessctl"):
-        print("[🚫] brightnessctl not found!")
-        return
-    percent = int(np.clip(percent, 5, 100))
-    os.system(f"brightnessctl set {percent}% > /dev/null 2>&1")
-    print(f"[🔆] Screen brightness set to: {percent}%")
+        if not _brightnessctl_missing_warned:
+            print("[🚫] brightnessctl not found!")
+            _brightnessctl_missing_warned = True
+        return None
+    if os.system(f"brightnessctl set {percent}% > /dev/null 2>&1") != 0:
+        if verbose:
+            print(f"[⚠️] brightnessctl failed to set brightness to {percent}%")
+        return None
+    if verbose:
+        print(f"[🔆] Screen brightness set to: {percent}%")
+    return percent
 
 
 def ambient_to_percent(brightness, ambient_min=40, ambient_max=170):
     """
     Maps ambient light value to screen brightness percentage.
     """
-    return int(np.clip(np.interp(brightness, [ambient_min, ambient_max], [10, 100]), 5, 100))
+    # Plain-Python equivalent of np.interp over [ambient_min, ambient_max] -> [10, 100]
+    if brightness <= ambient_min:
+        pct = 10
+    elif brightness >= ambient_max:
+        pct = 100
+    else:
+        pct = 10 + (brightness - ambient_min) * 90 / (ambient_max - ambient_min)
+    return max(5, min(100, int(pct)))
 
 
-def main():
+async def main_async():
     print("[🚀] Smart Brightness starting up...")
 
-    profile = load_camera_profile()
-    if not profile:
-        print("[⚠️] Could not proceed without calibration.")
-        return
+    import cv2
+
+    # One capture shared by calibration and sampling, so the device is negotiated only once
+    print("[📸] Initializing webcam...")
+    cap = cv2.VideoCapture(0)
+    # Calibration (possibly a subprocess) and frame sampling block, so keep them off the event loop
+    loop = asyncio.get_running_loop()
+    try:
+        profile = await loop.run_in_executor(None, load_camera_profile, cap if cap.isOpened() else None)
+        if not profile:
+            print("[⚠️] Could not proceed without calibration.")
+            return
 
-    ambient_min = profile.get("ambient_min", 40)
-    ambient_max = profile.get("ambient_max", 170)
+        ambient_min = profile.get("ambient_min", 40)
+        ambient_max = profile.get("ambient_max", 170)
+
+        ambient = await loop.run_in_executor(None, get_average_brightness, profile, cap)
+    finally:
+        cap.release()
 
-    ambient = get_average_brightness()
     if ambient is None:
         print("[⚠️] Adjustment skipped due to webcam/data issue.")
         return
@@ -177,15 +316,37 @@ def main():
     current_percent = get_current_brightness()
 
     print(f"[🎯] Transition from {current_percent}% → {target_percent}%")
-    smooth_transition(
+
+    # Quiet per-step writes; report only the last level that was actually applied
+    last_applied = None
+
+    def apply_step(percent):
+        nonlocal last_applied
+        applied = set_brightness(percent, verbose=False)
+        if applied is not None:
+            last_applied = applied
+
+    # Without a readable backlight every poll would just warn and report 50%, so skip verification
+    can_read = _BRIGHTNESS_READ_FD is not None and MAX_BRIGHTNESS
+    final_percent = await smooth_transition_async(
         current=current_percent,
         target=target_percent,
-        setter=set_brightness,
-        reader=get_current_brightness
+        setter=apply_step,
+        reader=get_current_brightness if can_read else None,
+        hw_steps=MAX_BRIGHTNESS or 100
     )
+    if final_percent is not None:
+        if last_applied is None:
+            print("[⚠️] Brightness could not be applied.")
+            return
+        print(f"[🔆] Screen brightness set to: {last_applied}%")
     print("[✅] Brightness adjustment complete.")
 
 
+def main():
+    asyncio.run(main_async())
+
+
 if __name__ == "__main__":
     main()
 